@@ -1,32 +1,48 @@
+import os
 import functools
+from concurrent.futures import ThreadPoolExecutor
+from math import prod, isfinite
 import numpy as np
 from .tensor import Function, GPUBuffer
 
-def buffer_new(ctx, shape, zero=False):
-  return GPUBuffer(shape, hostbuf=None if not zero else np.zeros(shape, dtype=np.float32))
+def buffer_new(ctx, shape):
+  return GPUBuffer(shape)
 
-def buffer_np(ctx, x):
-  return ctx.thr.to_device(x)
+@functools.lru_cache(maxsize=4096)
+def int_buf(thr, tup):
+  # read-only int32 shape/order args, uploaded once per (thr, tuple). the upload is async on the
+  # in-order queue (the event keeps the host copy alive), thr.to_device would finish the whole queue
+  ret = thr.array((len(tup),), np.int32)
+  ret.set(np.asarray(tup, dtype=np.int32), async_=True)
+  return ret
 
-@functools.lru_cache()
+# binaries persist across processes in the pyopencl/ICD (or pycuda) disk cache,
+# keyed on source, options, device and driver. this only skips the lookup.
+@functools.lru_cache(maxsize=None)
+def clprogram(thr, prg):
+  return thr.compile(prg)
+
+@functools.lru_cache(maxsize=None)
 def clbuild(thr, prg, name):
-  return thr.compile(prg).__getattr__(name)
+  return clprogram(thr, prg).__getattr__(name)
 
-def uint2(x, y):
-  return np.array((x,y), dtype=cl.cltypes.uint2)
 i32 = np.int32
 
 # ************* unary ops *************
 
+@functools.lru_cache()
+def get_unop_prg(thr, code):
+  # 4 elements per thread, plain loads rather than vload4 so it also builds for CUDA, the last thread does the n%4 tail
+  return clbuild(thr, """
+  KERNEL void unop(GLOBAL_MEM const float *a_g, GLOBAL_MEM float *res_g, int n) {
+    int gid = get_global_id(0)*4;
+    for (int i = gid; i < min(gid+4, n); i++) { float a = a_g[i]; res_g[i] = """ + code + """; }
+  }""", "unop")
+
 def unary_op(ctx, code, x):
   ret = buffer_new(ctx, x.shape)
-  unop = clbuild(ctx.thr, """
-  KERNEL void unop(GLOBAL_MEM const float *a_g, GLOBAL_MEM float *res_g) {
-    SIZE_T gid = get_global_id(0);
-    float a = a_g[gid];
-    res_g[gid] = """ + code + """;
-  }""", "unop")
-  unop(x.cl, ret.cl, global_size=[int(np.prod(ret.shape))])
+  unop = get_unop_prg(ctx.thr, code)
+  unop(x.cl, ret.cl, i32(prod(ret.shape)), global_size=[-(-prod(ret.shape)//4)])
   return ret
 
 class ReLU(Function):
@@ -65,48 +81,64 @@ class Exp(Function):
 
 # ************* reduce ops *************
 
-def reduce_op(ctx, code, code2, inp, axis=None, start="0.0"):
-  if axis is None:
-    # full reduce
-    osize = [1]*len(inp.shape)
-  else:
-    osize = np.array(inp.shape)
-    osize[list(axis)] = 1
-  ret = buffer_new(ctx, osize)
-  if axis is None:
-    ret.shape = (1,)
+def run_index(var, runs):
+  # flat offset of var unraveled over (size, stride) runs, both baked in as constants
+  divs = [prod(size for size,_ in runs[i+1:]) for i in range(len(runs))]
+  return " + ".join(["(%s/%d)%%%d*%d" % (var, div, size, stride) for div,(size,stride) in zip(divs, runs)]) or "0"
 
-  # TODO: this is insanely slow
-  reduce = clbuild(ctx.thr, """
-  KERNEL void reduce(GLOBAL_MEM const float *a_g, int sz, GLOBAL_MEM float *res_g, int prod, int n_dims,
-                       GLOBAL_MEM const int *shape_x, GLOBAL_MEM const int *shape_ret) {
-    SIZE_T gid = get_global_id(0);
+@functools.lru_cache()
+def get_reduce_prg(thr, code, code2, start, bs, rs, kept=None, reduced=None):
+  # (K0, R, K1): a workgroup of bs lanes over contiguous k1 by rs threads striding r, then a tree over rs in local memory
+  # with kept it is the generic kernel, one k0 per output and the index into a_g specialized on the runs
+  base, idx = ("\n    int base = " + run_index("k0", kept) + ";", "\n      int idx = base + " + run_index("r", reduced) + ";") \
+    if kept is not None else ("", "\n      int idx = (k0*R + r)*K1 + k1;")
+  return clbuild(thr, """
+  #define BS """ + str(bs) + """
+  #define RS """ + str(rs) + """
+  KERNEL void reduce(GLOBAL_MEM const float *a_g, GLOBAL_MEM float *res_g, int R, int K1) {
+    int k1 = get_global_id(0), k0 = get_group_id(1), lk = get_local_id(0), lr = get_local_id(1);""" + base + """
+    LOCAL_MEM float buf[RS][BS];
 
     float out = """ + start + """;
-    for (int x = 0; x < sz; x++) {
-      int idx = 0;  // compute index into a_g
-      int tprod = prod;
-      int tsz = sz;
-      for (int dim = 0; dim < n_dims; dim++) {
-        idx *= shape_x[dim];
-        if (shape_x[dim] == shape_ret[dim]) {   // dim from gid, don't reduce
-          tprod /= shape_x[dim];
-          idx += (gid / tprod) % shape_x[dim];
-        } else {  // dim from x
-          tsz /= shape_x[dim];
-          idx += (x / tsz) % shape_x[dim];
-        }
-      }
+    for (int r = lr; k1 < K1 && r < R; r += RS) {""" + idx + """
       float a = a_g[idx];
       """ + code + """;
     }
-    res_g[gid] = """ + code2 + """;
+    buf[lr][lk] = out;
+    for (int s = RS/2; s > 0; s >>= 1) {
+      LOCAL_BARRIER;
+      if (lr < s) { float a = buf[lr+s][lk]; """ + code + """; buf[lr][lk] = out; }
+
+    }
+    if (lr == 0 && k1 < K1) res_g[k0*K1 + k1] = """ + code2 + """;
   }""", "reduce")
-  reduce(inp.cl,
-    i32(np.prod(inp.shape)//np.prod(osize)), ret.cl,
-    i32(np.prod(osize)), i32(len(osize)),
-    buffer_np(ctx, np.array(inp.shape, dtype=np.int32)),
-    buffer_np(ctx, np.array(osize, dtype=np.int32)), global_size=[int(np.prod(osize))])
+
+def reduce_op(ctx, code, code2, inp, axis=None, start="0.0"):
+  # full reduce if axis is None
+  osize = [1 if axis is None or i in axis else s for i,s in enumerate(inp.shape)]
+  ret = buffer_new(ctx, osize)
+  if axis is None:
+    ret.shape = (1,)
+
+  # collapse adjacent kept/reduced dims into runs, KR, RK and KRK are all a (K0, R, K1) reduce
+  runs = []
+  for s,o in [(s,o) for s,o in zip(inp.shape, osize) if s > 1]:
+    if len(runs) > 0 and runs[-1][0] == (s == o): runs[-1][1] *= s
+    else: runs.append([s == o, s])
+  if len(runs) == 0 or not runs[0][0]: runs.insert(0, [True, 1])
+  if len(runs) < 2 or runs[1][0]: runs.insert(1, [False, 1])
+  if len(runs) < 3: runs.append([True, 1])
+
+  # anything else (KRKR...) takes the generic index math with one output per k0
+  generic = len(runs) > 3
+  K0, R, K1 = (prod(osize), prod(inp.shape)//prod(osize), 1) if generic else (r[1] for r in runs)
+  bs = min(32, 1 << (K1-1).bit_length())
+  rs = min(256//bs, 1 << (R-1).bit_length())
+  # the generic kernel gets the (size, stride) of the kept runs, indexed by k0, and of the reduced ones, indexed by r
+  runs = [(keep, size, prod(r[1] for r in runs[i+1:])) for i,(keep,size) in enumerate(runs) if size > 1]
+  kept_reduced = [tuple((size, stride) for k,size,stride in runs if k == keep) for keep in [True, False]] if generic else []
+  reduce = get_reduce_prg(ctx.thr, code, code2, start, bs, rs, *kept_reduced)
+  reduce(inp.cl, ret.cl, i32(R), i32(K1), global_size=[-(-K1//bs)*bs, K0*rs], local_size=[bs, rs])
   return ret
 
 class Sum(Function):
@@ -124,7 +156,8 @@ class Sum(Function):
     input, axis = ctx.saved_tensors
     shape = [1 if axis is None or i in axis else input.shape[i] for i in range(len(input.shape))]
     output = GPUBuffer(shape, hostbuf=grad_output)
-    return binary_op(ctx, 'a+b', output, buffer_new(ctx, input.shape, zero=True))
+    # broadcast against input for its shape, b is never read
+    return binary_op(ctx, 'a', output, input)
 
 class Max(Function):
   @staticmethod
@@ -142,15 +175,17 @@ class Max(Function):
     shape = [1 if axis is None or i in axis else input.shape[i] for i in range(len(input.shape))]
     ret2 = binary_op(ctx, "1.0*(a==b)", input, GPUBuffer(shape, ret))
     div = reduce_op(ctx, "out += a", "out+1e-10", ret2, axis=axis)
-    ret3 = binary_op(ctx, "a/b", ret2, GPUBuffer(shape, div))
-    return binary_op(ctx, 'a*b', ret3, GPUBuffer(shape, grad_output))
+    # divide and scale in one pass, grad_output and div both broadcast like y
+    return binary_op(ctx, 'a*b/c', ret2, GPUBuffer(shape, grad_output), div)
 
 # ************* binary ops *************
 
 @functools.lru_cache()
-def get_binop_prg(thr, code, complist):
+def get_binop_prg(thr, code, complist, vec=1, nextra=0):
   ndims = len(complist)
-  args = "".join([", int d%d" % i for i in range(ndims)]) + "".join([", int p%d" % i for i in range(ndims-1)])
+  # extra inputs c, d, ... broadcast like y
+  ins = [("a", "x_g", 0), ("b", "y_g", 1)] + [(n, n+"_g", 1) for n in "cdef"[:nextra]]
+  args = "".join([", GLOBAL_MEM const float *%s" % g for _,g,_ in ins[2:]] + [", int d%d" % i for i in range(ndims)] + [", int p%d" % i for i in range(ndims-1)])
   compute_idx_rets = ["\n    int idx_ret"+str(i)+" = (gid0 / "+("p%d"%i if i < ndims-1 else "1")+") % d"+str(i)+";" for i in range(ndims)]
 
   idx_exprs = ["0", "0"] # [idx_x, idx_y]
@@ -159,20 +194,23 @@ def get_binop_prg(thr, code, complist):
       if complist[i][j]:
         idx_exprs[j] = "idx_ret%d + d%d*(%s)" % (i, i, idx_exprs[j])
 
+  # each thread does vec adjacent outputs of the inner dim, a side broadcasting in it reads one element.
+  # plain loads rather than vload4/float4, which only exist in OpenCL C and would break GPAPI=cuda
+  body = "\n    for (int i = 0; i < %d; i++) {" % vec + \
+    "".join(["\n      float %s = %s[%s%s];" % (n, g, idx_exprs[j], " + i" if vec > 1 and complist[-1][j] else "") for n,g,j in ins]) + \
+    "\n      res_g[gid0 + i] = " + code + ";\n    }"
+
   return clbuild(thr, """KERNEL void binop(GLOBAL_MEM const float *x_g, GLOBAL_MEM const float *y_g, GLOBAL_MEM float *res_g""" + args + """) {
-    int gid0 = get_global_id(0);"""+"".join(compute_idx_rets)+"""
-    float a = x_g["""+idx_exprs[0]+"""];
-    float b = y_g["""+idx_exprs[1]+"""];
-    res_g[gid0] = """+code+""";\n}""", "binop")
+    int gid0 = get_global_id(0)*"""+str(vec)+""";"""+"".join(compute_idx_rets)+body+"""\n}""", "binop")
 
-def binary_op(ctx, code, x, y):
+def binary_op(ctx, code, x, y, *extra):
+  # any extra inputs are read as c, d, ... with y's index, so they must have as many elements as y
+  assert all(prod(e.shape) == prod(y.shape) for e in extra)
   n_dims = max(len(x.shape), len(y.shape))
-  shape_x, shape_y = np.ones(n_dims, dtype=np.int32), np.ones(n_dims, dtype=np.int32)
-  shape_x[:len(x.shape)] = np.array(x.shape, dtype=np.int32)
-  shape_y[:len(y.shape)] = np.array(y.shape, dtype=np.int32)
-  if not np.all((shape_x == 1) | (shape_y == 1) | (shape_x == shape_y)):
+  shape_x, shape_y = list(x.shape) + [1]*(n_dims-len(x.shape)), list(y.shape) + [1]*(n_dims-len(y.shape))
+  if not all(sx == 1 or sy == 1 or sx == sy for sx,sy in zip(shape_x, shape_y)):
     raise Exception(f"binary op unbroadcastable shape mismatch: {x.shape} vs {y.shape}")
-  shape_ret = np.maximum(shape_x, shape_y)
+  shape_ret = [max(sx, sy) for sx,sy in zip(shape_x, shape_y)]
 
   dimlist, complist = [], [] # note: len(dimlist) may be less than n_dims
   def push(dim, comp):
@@ -181,15 +219,17 @@ def binary_op(ctx, code, x, y):
     elif comp != (False, False):
       dimlist.append(dim); complist.append(comp)
   for i in range(n_dims): # group together any adjacent dimensions that we can to simplify broadcasting
-    push(i32(max(shape_x[i], shape_y[i])), (shape_x[i] > 1, shape_y[i] > 1))
+    push(shape_ret[i], (shape_x[i] > 1, shape_y[i] > 1))
 
-  prg = get_binop_prg(ctx.thr, code, tuple(complist))
-  ret = buffer_new(ctx, shape_ret, zero=True)
-  prod_list = np.array(dimlist, dtype=i32)[-1::-1].cumprod(dtype=i32)[-1::-1] # take cumprod from back to front
-  prg(x.cl, y.cl, ret.cl, *dimlist, *(prod_list[1:]),global_size=[int(prod_list[0])] if len(dimlist) > 0 else [int(1)])
+  vec = 4 if len(dimlist) > 0 and dimlist[-1] % 4 == 0 else 1
+  prg = get_binop_prg(ctx.thr, code, tuple(complist), vec, len(extra))
+  ret = buffer_new(ctx, shape_ret)
+  prod_list = [prod(dimlist[i:]) for i in range(len(dimlist))] # take cumprod from back to front
+  prg(x.cl, y.cl, ret.cl, *[e.cl for e in extra], *map(i32, dimlist + prod_list[1:]), global_size=[prod(dimlist)//vec])
   return ret
 
 def unbroadcast(ctx, out, in_sh):
+  if out.shape == tuple(in_sh): return out
   sum_axis = [i for i in range(len(in_sh)) if in_sh[i]==1 and out.shape[i]>1] if in_sh != (1,) else None
   return reduce_op(ctx, "out += a", "out", out, sum_axis)
 
@@ -201,9 +241,8 @@ class Add(Function):
 
   @staticmethod
   def backward(ctx, grad_output):
-    grad_x, grad_y = grad_output, grad_output
     shape_x, shape_y = ctx.saved_tensors
-    return unbroadcast(ctx, grad_x, shape_x), unbroadcast(ctx, grad_y, shape_y),
+    return unbroadcast(ctx, grad_output, shape_x), unbroadcast(ctx, grad_output, shape_y)
 
 class Sub(Function):
   @staticmethod
@@ -213,9 +252,9 @@ class Sub(Function):
 
   @staticmethod
   def backward(ctx, grad_output):
-    grad_x, grad_y = grad_output, unary_op(ctx, '-a', grad_output)
     shape_x, shape_y = ctx.saved_tensors
-    return unbroadcast(ctx, grad_x, shape_x), unbroadcast(ctx, grad_y, shape_y),
+    # negate after the reduce, on the smaller tensor
+    return unbroadcast(ctx, grad_output, shape_x), unary_op(ctx, '-a', unbroadcast(ctx, grad_output, shape_y))
 
 class Mul(Function):
   @staticmethod
@@ -230,19 +269,28 @@ class Mul(Function):
     grad_y = binary_op(ctx, 'a*b', x, grad_output)
     return unbroadcast(ctx, grad_x, x.shape), unbroadcast(ctx, grad_y, y.shape),
 
+def pow_code(e, ex="b"):
+  # a**ex, where ex evaluates to e if the exponent is known host side. pow() is slow, so take the cheap forms
+  # only builtins CUDA has too, so no pown/rsqrt. small integers multiply out, inf/nan and the rest go to pow
+  cheap = {0: "1.0f", 0.5: "sqrt(a)", -0.5: "1.0f/sqrt(a)"}
+  if e in cheap: return cheap[e]
+  if e is None or not isfinite(e) or abs(e) > 8: return "pow(a, %s)" % ex
+  if e != int(e): return "exp((%s)*log(a))" % ex
+  return ("%s" if e > 0 else "1.0f/(%s)") % "*".join(["a"]*abs(int(e)))
+
 class Pow(Function):
   @staticmethod
   def forward(ctx, x, y):
     ctx.save_for_backward(x, y)
-    return binary_op(ctx, 'pow(a,b)', x, y)
+    return binary_op(ctx, pow_code(y.scalar), x, y)
 
   @staticmethod
   def backward(ctx, grad_output):
     x,y = ctx.saved_tensors
     grad_x = binary_op(ctx, 'a*b', grad_output,
-                      binary_op(ctx, 'b * (pow((float)a, (float)(b-1.0)))', x, y))
+                      binary_op(ctx, 'b * (%s)' % pow_code(None if y.scalar is None else y.scalar-1, "b-1.0f"), x, y))
     grad_y = binary_op(ctx, 'a*b', grad_output,
-                      binary_op(ctx, 'pow(a, (float)b) * log(a);', x, y))
+                      binary_op(ctx, '(%s) * log(a)' % pow_code(y.scalar), x, y))
     return unbroadcast(ctx, grad_x, x.shape), unbroadcast(ctx, grad_y, y.shape),
 
 # ************* movement ops *************
@@ -251,9 +299,9 @@ class Reshape(Function):
   @staticmethod
   def forward(ctx, x, shape):
     ctx.save_for_backward(x.shape)
-    shape = tuple(-np.prod(x.shape) // np.prod(shape) if s == -1 else s for s in shape)
+    shape = tuple(-prod(x.shape) // prod(shape) if s == -1 else s for s in shape)
     r = GPUBuffer(shape, hostbuf=x)
-    assert np.prod(x.shape) == np.prod(r.shape)
+    assert prod(x.shape) == prod(r.shape)
     return r
 
   @staticmethod
@@ -261,10 +309,18 @@ class Reshape(Function):
     in_shape, = ctx.saved_tensors
     return GPUBuffer(in_shape, hostbuf=grad_output)
 
-def perm_axis(ctx, inp, order):
-  osize = np.array(inp.shape)[list(order)]
-  ret = buffer_new(ctx, osize)
-  perm = clbuild(ctx.thr, """
+def get_perm_prg(thr, name="perm"):
+  return clbuild(thr, """
+  KERNEL void transpose(GLOBAL_MEM const float *a_g, GLOBAL_MEM float *res_g, int H, int W) {
+    // batched (H, W) -> (W, H) through a 32x32 local tile, padded so walking a column doesn't hit one bank
+    LOCAL_MEM float tile[32][33];
+    int tx = get_local_id(0), ty = get_local_id(1), bx = get_group_id(0)*32, by = get_group_id(1)*32;
+    SIZE_T off = get_global_id(2)*H*W;
+    for (int j = 0; j < 32; j += 8) if (bx+tx < W && by+ty+j < H) tile[ty+j][tx] = a_g[off + (by+ty+j)*W + bx+tx];
+    LOCAL_BARRIER;
+    for (int j = 0; j < 32; j += 8) if (by+tx < H && bx+ty+j < W) res_g[off + (bx+ty+j)*H + by+tx] = tile[tx][ty+j];
+  }
+
   KERNEL void perm(GLOBAL_MEM const float *a_g, GLOBAL_MEM float *res_g, int n_axis,
                        GLOBAL_MEM const int *shape, GLOBAL_MEM const int *order) {
     SIZE_T gid = get_global_id(0);
@@ -277,10 +333,20 @@ def perm_axis(ctx, inp, order):
       gi /= shape[order[i]];
     }
     res_g[gid] = a_g[idx];
-    }""", "perm")
+    }""", name)
+
+def perm_axis(ctx, inp, order):
+  osize = [inp.shape[i] for i in order]
+  ret = buffer_new(ctx, osize)
+  if tuple(order) == tuple(range(len(order)-2)) + (len(order)-1, len(order)-2):
+    # swap of the last two axes (H, W), coalesced on both sides
+    transpose, (H, W) = get_perm_prg(ctx.thr, "transpose"), inp.shape[-2:]
+    transpose(inp.cl, ret.cl, i32(H), i32(W),
+      global_size=[-(-W//32)*32, -(-H//32)*8, prod(inp.shape[:-2])], local_size=[32, 8, 1])
+    return ret
+  perm = get_perm_prg(ctx.thr)
   perm(inp.cl, ret.cl, i32(len(osize)),
-    buffer_np(ctx, np.array(inp.shape, dtype=np.int32)),
-    buffer_np(ctx, np.array(order, dtype=np.int32)), global_size=[int(np.prod(osize))])
+    int_buf(ctx.thr, tuple(inp.shape)), int_buf(ctx.thr, tuple(order)), global_size=[prod(osize)])
   return ret
 
 class Transpose(Function):
@@ -291,14 +357,13 @@ class Transpose(Function):
 
   @staticmethod
   def backward(ctx, grad_output):
-    return perm_axis(ctx, grad_output, np.argsort(ctx.order))
+    inv = [0]*len(ctx.order)
+    for i,o in enumerate(ctx.order): inv[o] = i
+    return perm_axis(ctx, grad_output, tuple(inv))
 
 # TODO: merge this with perm axis
-def inner_slice(ctx, x, arg):
-  shift = [y[0] for y in arg]
-  oshape = [y[1]-y[0] for y in arg]
-  ret = buffer_new(ctx, oshape)
-  gslice = clbuild(ctx.thr, """
+def get_gslice_prg(thr):
+  return clbuild(thr, """
   KERNEL void gslice(GLOBAL_MEM const float *input, GLOBAL_MEM float *output, int prod, int n_dims,
                      GLOBAL_MEM const int *shape_x, GLOBAL_MEM const int *shape_ret,
                      GLOBAL_MEM const int *shift) {
@@ -313,10 +378,15 @@ def inner_slice(ctx, x, arg):
     }
     output[gid] = zero ? input[iptr] : 0.0;
   }""","gslice")
-  gslice(x.cl, ret.cl, i32(np.prod(ret.shape)), i32(len(ret.shape)),
-    buffer_np(ctx, np.array(x.shape, dtype=np.int32)),
-    buffer_np(ctx, np.array(ret.shape, dtype=np.int32)),
-    buffer_np(ctx, np.array(shift, dtype=np.int32)), global_size=[int(np.prod(ret.shape))])
+
+def inner_slice(ctx, x, arg):
+  shift = [y[0] for y in arg]
+  oshape = [y[1]-y[0] for y in arg]
+  ret = buffer_new(ctx, oshape)
+  gslice = get_gslice_prg(ctx.thr)
+  gslice(x.cl, ret.cl, i32(prod(ret.shape)), i32(len(ret.shape)),
+    int_buf(ctx.thr, tuple(x.shape)), int_buf(ctx.thr, tuple(ret.shape)),
+    int_buf(ctx.thr, tuple(shift)), global_size=[prod(ret.shape)])
   return ret
 
 class Slice(Function):
@@ -333,58 +403,135 @@ class Slice(Function):
 
 # ************* processing ops *************
 
+def get_matmul_prg(thr, name="matmul"):
+  return clbuild(thr, """
+  #define TS 16
+  KERNEL void matmul(
+    GLOBAL_MEM const float *input, GLOBAL_MEM const float *weight, GLOBAL_MEM float *res,
+    int isize, int is0, int is1, int msize, int ws0, int ws1, int osize, int icnt
+  ) {
+    SIZE_T stride = get_global_id(2);
+
+    SIZE_T X = get_global_id(0); // isize
+    SIZE_T Y = get_global_id(1); // osize
+
+    input += isize*msize*(stride % icnt);
+    weight += msize*osize*stride;
+    float ret = 0.0;
+    for (int x = 0; x < msize; x++) {
+      ret += input[X * is0 + x * is1] * weight[Y * ws0 + x * ws1];
+    }
+
+    res[X * osize + Y + isize*osize*stride] = ret;
+  }
+
+  KERNEL void matmul_tiled(
+    GLOBAL_MEM const float *input, GLOBAL_MEM const float *weight, GLOBAL_MEM float *res,
+    int isize, int is0, int is1, int msize, int ws0, int ws1, int osize, int icnt
+  ) {
+    SIZE_T stride = get_global_id(2);
+    int tx = get_local_id(0), ty = get_local_id(1);
+    int X = get_group_id(0)*TS + ty;  // isize
+    int Y = get_group_id(1)*TS + tx;  // osize, on the fast local id so res (and weight rows) coalesce
+    LOCAL_MEM float it[TS][TS], wt[TS][TS];
+
+    input += isize*msize*(stride % icnt);
+    weight += msize*osize*stride;
+    float ret = 0.0;
+    for (int k = 0; k < msize; k += TS) {
+      it[ty][tx] = (X < isize && k+tx < msize) ? input[X * is0 + (k+tx) * is1] : 0.0f;
+      wt[ty][tx] = (Y < osize && k+ty < msize) ? weight[Y * ws0 + (k+ty) * ws1] : 0.0f;
+      LOCAL_BARRIER;
+      for (int x = 0; x < TS; x++) ret += it[ty][x] * wt[x][tx];
+      LOCAL_BARRIER;
+    }
+
+    if (X < isize && Y < osize) res[X * osize + Y + isize*osize*stride] = ret;
+  }""", name)
+
+def matmul_op(ctx, input, weight, ret, isize, is0, is1, msize, ws0, ws1, osize, cnt, icnt=None):
+  # (isize,msize) x (msize,osize) = (isize,osize) batched cnt times, the input batch wraps every icnt
+  # 16x16 tiles through local memory, the tiny shapes that can't fill a tile use the plain kernel
+  tiled = isize >= 16 and osize >= 16
+  matmul = get_matmul_prg(ctx.thr, "matmul_tiled" if tiled else "matmul")
+  args = [i32(x) for x in [isize, is0, is1, msize, ws0, ws1, osize, icnt or cnt]]
+  gsize = [-(-isize//16)*16, -(-osize//16)*16, cnt] if tiled else [isize, osize, cnt]
+  matmul(input.cl, weight.cl, ret.cl, *args, global_size=[int(x) for x in gsize], local_size=[16, 16, 1] if tiled else None)
+
 class Matmul(Function):
   @staticmethod
   def forward(ctx, input, weight):
     assert input.shape[-1] == weight.shape[-2]
-    cnt = np.prod(input.shape[0:-2]) if len(input.shape) > 2 else 1
-    isize, msize, osize = i32(input.shape[-2]), i32(input.shape[-1]), i32(weight.shape[-1])
+    cnt = prod(input.shape[0:-2])
+    isize, msize, osize = input.shape[-2], input.shape[-1], weight.shape[-1]
     ret = buffer_new(ctx, list(input.shape[0:-2])+[isize, osize])
-
-    matmul = clbuild(ctx.thr, """
-     KERNEL void matmul(
-       GLOBAL_MEM const float *input, GLOBAL_MEM const float *weight, GLOBAL_MEM float *res,
-       int isize, int is0, int is1, int msize, int ws0, int ws1, int osize
-    ) {
-       SIZE_T stride = get_global_id(2);
-
-       SIZE_T X = get_global_id(0); // isize
-       SIZE_T Y = get_global_id(1); // osize
-
-      float ret = 0.0;
-      for (int x = 0; x < msize; x++) {
-        ret += input[X * is0 + x * is1 + isize*msize*stride] *
-          weight[Y * ws0 + x * ws1 + msize*osize*stride];
-      }
-
-      res[X * osize + Y + isize*osize*stride] = ret;
-    }""", "matmul")
-    ctx.save_for_backward(input, weight, matmul, cnt)
+    ctx.save_for_backward(input, weight, cnt)
 
     # (isize,msize) x (msize,osize) = (isize,osize)
-    matmul(input.cl, weight.cl, ret.cl, isize,
-      msize, i32(1), msize, i32(1), osize, osize, global_size=[int(isize), int(osize), int(cnt)])
+    matmul_op(ctx, input, weight, ret, isize, msize, 1, msize, 1, osize, osize, cnt)
     return ret
 
   @staticmethod
   def backward(ctx, grad_output):
-    input, weight, matmul, cnt = ctx.saved_tensors
-    isize, msize, osize = i32(input.shape[-2]), i32(input.shape[-1]), i32(weight.shape[-1])
+    input, weight, cnt = ctx.saved_tensors
+    isize, msize, osize = input.shape[-2], input.shape[-1], weight.shape[-1]
 
     grad_input = buffer_new(ctx, input.shape)
     grad_weight = buffer_new(ctx, weight.shape)
 
     # (isize,osize) x (msize,osize) = (isize,msize)
-    matmul(grad_output.cl, weight.cl, grad_input.cl, isize,
-                  osize, i32(1), osize, osize, i32(1), msize, global_size=[int(isize), int(msize), int(cnt)])
+    matmul_op(ctx, grad_output, weight, grad_input, isize, osize, 1, osize, osize, 1, msize, cnt)
 
     # (isize,msize) x (isize,osize) = (msize,osize)
-    matmul(
-      input.cl, grad_output.cl, grad_weight.cl, msize,
-      i32(1), msize, isize, i32(1), osize, osize, global_size=[int(msize), int(osize), int(cnt)])
+    matmul_op(ctx, input, grad_output, grad_weight, msize, 1, msize, isize, 1, osize, osize, cnt)
 
     return grad_input, grad_weight
 
+def get_conv_prg(thr, name="im2col"):
+  # the conv geometry comes in as one int buffer, see conv_args
+  return clbuild(thr, """
+  #define CONV_ARGS int H = args[0], W = args[1], groups = args[2], rcout = args[3], cin = args[4], oy = args[5], \\
+    ox = args[6], iy = args[7], ix = args[8], ys = args[9], xs = args[10], bs = args[11];
+
+  // im2col, one thread per col element so the stores are contiguous. col is (bs*groups, cin*H*W, oy*ox),
+  // or with bt (groups, cin*H*W, bs*oy*ox) so one matmul per group covers the whole batch
+  KERNEL void im2col(GLOBAL_MEM const float *input, GLOBAL_MEM float *col, GLOBAL_MEM const int *args, int bt) {
+    CONV_ARGS
+    int gid = get_global_id(0);
+    int X = gid % ox, Y = (gid / ox) % oy;
+    int B = bt ? (gid / (oy*ox)) % bs : 0, r = gid / (oy*ox*(bt ? bs : 1));
+    int x = r % W, y = (r / W) % H;
+    int gci = r / (W*H);  // g*cin + ci, plus B*groups*cin without bt
+    col[gid] = input[(B*groups*cin + gci)*iy*ix + (Y*ys+y)*ix + X*xs+x];
+  }
+
+  KERNEL void convx(GLOBAL_MEM const float *tensw, GLOBAL_MEM const float *ggg, GLOBAL_MEM float *dx,
+    GLOBAL_MEM const int *args) {
+    CONV_ARGS
+
+    int IX = get_global_id(0);  // range 0-ix, fastest so the dx stores are contiguous
+    int IY = get_global_id(1);  // range 0-iy
+    int B = get_global_id(2)/(groups*cin);  // range 0-bs
+    int g = (get_global_id(2)/cin)%groups;
+    int ci = get_global_id(2) % cin;
+
+    // only the outputs whose window covers (IY, IX), each dx element has a single owner
+    float acc = 0.0;
+    for (int Y = max(0, (IY-H+ys)/ys); Y <= min(oy-1, IY/ys); Y++) {
+      for (int X = max(0, (IX-W+xs)/xs); X <= min(ox-1, IX/xs); X++) {
+        for (int c = 0; c < rcout; c++) {
+          acc += ggg[B*groups*rcout*oy*ox + g*rcout*oy*ox + c*oy*ox + Y*ox + X] * \
+            tensw[g*rcout*cin*H*W + c*cin*H*W + ci*H*W + (IY-Y*ys)*W + (IX-X*xs)];
+        }
+      }
+    }
+    dx[get_global_id(2)*iy*ix + IY*ix + IX] = acc;
+  }""", name)
+
+def conv_args(ctx, H, W, groups, rcout, cin, oy, ox, iy, ix, ys, xs, bs):
+  # cached on device, so forward and backward of the same conv share one upload
+  return int_buf(ctx.thr, (H, W, groups, rcout, cin, oy, ox, iy, ix, ys, xs, bs))
+
 class Conv2D(Function):
   @staticmethod
   def forward(ctx, x, w, stride=1, groups=1):
@@ -406,36 +553,15 @@ class Conv2D(Function):
     # input  = (bs, groups, cin, iy, ix)
     # weight = (groups, rcout, cin, H, W)
     # output = (bs, groups, rcout, oy, ox)
+    # col    = (bs, groups, cin*H*W, oy*ox)
 
-    conv = clbuild(ctx.thr, """
-    KERNEL void conv(GLOBAL_MEM const float *input, GLOBAL_MEM const float *weight, GLOBAL_MEM float *output,
-      int H, int W, int groups, int rcout, int cin, int oy, int ox, int iy, int ix, int ys, int xs) {
-
-      int B = get_global_id(0)/(groups*rcout);  // range 0-bs
-      int g = (get_global_id(0)/rcout)%groups;
-      int c = get_global_id(0) % rcout;
-
-      int Y = get_global_id(1);  // range 0-oy
-      int X = get_global_id(2);  // range 0-ox
-      int IY = Y*ys;
-      int IX = X*xs;
-
-      float acc = 0.0;
-      for (int ci = 0; ci < cin; ci++) {
-        for (int y = IY; y < IY+H; y++) {
-          for (int x = IX; x < IX+W; x++) {
-            acc += input[B*groups*cin*iy*ix + g*cin*iy*ix + ci*iy*ix + y*ix + x] * \
-              weight[g*rcout*cin*H*W + c*cin*H*W + ci*H*W + (y-IY)*W + (x-IX)];
-          }
-        }
-      }
-      output[B*groups*rcout*oy*ox + g*rcout*oy*ox + c*oy*ox + Y*ox + X] = acc;
-    }""","conv")
+    im2col = get_conv_prg(ctx.thr, "im2col")
+    col = buffer_new(ctx, (bs*groups, cin*H*W, oy*ox))
+    im2col(x.cl, col.cl, conv_args(ctx, H, W, groups, rcout, cin, oy, ox, iy, ix, ys, xs, bs), i32(0),
+      global_size=[prod(col.shape)])
 
-    conv(x.cl, w.cl, ret.cl,
-      i32(H), i32(W), i32(groups), i32(rcout), i32(cin),
-      i32(oy), i32(ox), i32(iy), i32(ix), i32(ys), i32(xs),
-      global_size=[int(bs * groups * rcout), int(oy), int(ox)])
+    # (rcout,cin*H*W) x (cin*H*W,oy*ox) = (rcout,oy*ox) for each of bs*groups, the weight repeats every groups
+    matmul_op(ctx, w, col, ret, rcout, cin*H*W, 1, cin*H*W, 1, oy*ox, oy*ox, bs*groups, groups)
     return ret
 
   @staticmethod
@@ -450,60 +576,31 @@ class Conv2D(Function):
     assert cout % ctx.groups == 0
     rcout = cout//ctx.groups
 
-    dx = buffer_new(ctx, (bs, cin_, iy, ix), zero=True)
-    dw = buffer_new(ctx, (cout, cin, H, W))
+    dx = buffer_new(ctx, (bs, cin_, iy, ix))
 
-    # tensx = (bs, groups*cin, iy, ix)
     # tensw = (groups*rcout, cin, H, W)
     # ggg = (bs, groups*rout, oy, ox)
 
-    convw = clbuild(ctx.thr, """
-    KERNEL void convw(GLOBAL_MEM const float *tensx, GLOBAL_MEM const float *ggg, GLOBAL_MEM float *dw,
-      int H, int W, int groups, int rcout, int cin, int oy, int ox, int iy, int ix, int ys, int xs, int bs) {
-
-      int g = get_global_id(0)/(rcout*cin) ; // range 0-groups
-      int c = (get_global_id(0)/(cin)) %rcout; // range 0-rcout
-      int ci = get_global_id(0) % cin;        // range 0-cin
-      int y = get_global_id(1);  // range 0-H
-      int x = get_global_id(2);  // range 0-W
-
-      float acc = 0.0;
-      for (int Y = 0; Y < oy; Y++) {
-        for (int X = 0; X < ox; X++) {
-          for (int B = 0; B < bs; B++) {
-            acc += ggg[B*groups*rcout*oy*ox + +g*rcout*oy*ox + c*oy*ox + Y*ox + X] * \
-              tensx[B*groups*cin*iy*ix + g*cin*iy*ix + ci*iy*ix + (Y*ys+y)*ix + X*xs+x];
-          }
-        }
-      }
-      dw[get_global_id(0)*H*W + y*W + x] = acc;
-    }""","convw")
-    convx = clbuild(ctx.thr, """
-    KERNEL void convx(GLOBAL_MEM const float *tensw, GLOBAL_MEM const float *ggg, GLOBAL_MEM float *dx,
-      int H, int W, int groups, int rcout, int cin, int oy, int ox, int iy, int ix, int ys, int xs, int bs) {
-
-      int B = get_global_id(0);
-      int g = get_global_id(1);
-      int ci = get_global_id(2);
-
-      for (int Y = 0; Y < oy; Y++) {
-        for (int X = 0; X < ox; X++) {
-          for (int y = 0; y < H; y++) {
-            for (int x = 0; x < W; x++) {
-              float acc = 0.0;
-              for (int c = 0; c < rcout; c++) {
-                acc += ggg[B*groups*rcout*oy*ox + g*rcout*oy*ox + c*oy*ox + Y*ox + X] * \
-                  tensw[g*rcout*cin*H*W + c*cin*H*W + ci*H*W + y*W + x];
-              }
-              dx[B*groups*cin*iy*ix + g*cin*iy*ix + ci*iy*ix + (Y*ys+y)*ix + X*xs+x] += acc;
-            }
-          }
-        }
-      }
-    }
-    """, "convx")
+    im2col, convx = get_conv_prg(ctx.thr, "im2col"), get_conv_prg(ctx.thr, "convx")
+    args = conv_args(ctx, H, W, ctx.groups, rcout, cin, oy, ox, iy, ix, ys, xs, bs)
+
+    # recompute col batch-minor and move the batch of ggg inside each group, both are freed after backward
+    # (rcout,bs*oy*ox) x (bs*oy*ox,cin*H*W) = (rcout,cin*H*W) for each of groups, the sum over bs is part of the matmul
+    col = buffer_new(ctx, (ctx.groups, cin*H*W, bs*oy*ox))
+    im2col(x.cl, col.cl, args, i32(1), global_size=[prod(col.shape)])
+    ggg = perm_axis(ctx, GPUBuffer((bs, cout, oy*ox), hostbuf=grad_output), (1, 0, 2))
+    dw = buffer_new(ctx, (cout, cin, H, W))
+    matmul_op(ctx, ggg, col, dw, rcout, bs*oy*ox, 1, bs*oy*ox, bs*oy*ox, 1, cin*H*W, ctx.groups)
 
-    conv_args = i32(H), i32(W), i32(ctx.groups), i32(rcout), i32(cin), i32(oy), i32(ox), i32(iy), i32(ix), i32(ys), i32(xs), i32(bs)
-    convw(x.cl, grad_output.cl, dw.cl, *conv_args, global_size=[int(ctx.groups * rcout * cin), int(H), int(W)])
-    convx(w.cl, grad_output.cl, dx.cl, *conv_args, global_size=[int(bs), int(ctx.groups), int(cin)])
+    convx(w.cl, grad_output.cl, dx.cl, args, global_size=[int(ix), int(iy), int(bs * ctx.groups * cin)])
     return dx, dw
+
+def precompile(thr):
+  # the OpenCL compiler runs without the GIL, so build the static programs concurrently.
+  # this only warms the caches, a program that fails to build is skipped and raises where an op first uses it
+  def build(job):
+    try: job[0](thr, *job[1:])
+    except Exception: pass
+  jobs = [(get_perm_prg,), (get_gslice_prg,), (get_matmul_prg,), (get_conv_prg,)] + \
+    [(get_unop_prg, code) for code in ['max(a, (float)0.)', 'log(a)', 'exp(a)', '-a']]  # ReLU, Log, Exp, Sub
+  with ThreadPoolExecutor(max_workers=os.cpu_count()) as pool: list(pool.map(build, jobs))
@@ -37,9 +37,13 @@ api, thr = None, None
 class GPUBuffer:
   def __init__(self, shape, hostbuf=None):
     self.shape, self.dtype = tuple(shape), np.float32
+    # without a hostbuf the device memory is left uninitialized, every op writes all of its output
     self.cl = hostbuf.cl if isinstance(hostbuf, GPUBuffer) else \
-      thr.to_device((hostbuf.astype(np.float32).ravel() if not hostbuf.data.contiguous \
-                       else hostbuf.astype(np.float32)) if hostbuf is not None else np.zeros(shape, np.float32))
+      thr.array(self.shape, self.dtype) if hostbuf is None else \
+      thr.to_device(hostbuf.astype(np.float32).ravel() if not hostbuf.data.contiguous else hostbuf.astype(np.float32))
+    # host value of one element buffers (the constants dispatch wraps), so ops can specialize their kernels on it
+    self.scalar = hostbuf.scalar if isinstance(hostbuf, GPUBuffer) else \
+      float(hostbuf.ravel()[0]) if hostbuf is not None and hostbuf.size == 1 else None
 
   def __repr__(self):
     return f"<GPUBuffer with shape {self.shape!r} and data {self.cl.get()}>"
@@ -337,6 +341,8 @@ try:
   _register_ops(ops_gpu, device=Device.GPU)
   api = cluda.cuda_api() if os.environ.get("GPAPI", "opencl") == "cuda" else cluda.ocl_api()
   thr = api.Thread.create()
+  # warming is only for OpenCL, the backend these programs are built and tested against
+  if DEFAULT_DEVICE == Device.GPU and api.get_id() == cluda.ocl_id(): ops_gpu.precompile(thr)
   GPU = True
 except ImportError:
   # no GPU support